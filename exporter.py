@@ -1,18 +1,23 @@
 import os
 import os.path
 import signal
+import threading
 import subprocess
-import json
 import datetime
-import re
+import functools
 import argparse
+import collections
 import logging
+import operator
 import time
 from logging import warning, info, debug, error  # noqa: F401
 from prometheus_client import start_http_server
 from prometheus_client import Gauge
 import psycopg2
-from psycopg2.extras import DictCursor
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 
 # Configuration
@@ -22,7 +27,12 @@ parser = argparse.ArgumentParser()
 parser.add_argument("archive_dir",
                     help="pg_wal/archive_status/ Directory location")
 parser.add_argument("--debug", help="enable debug log", action="store_true")
+parser.add_argument("--max-basebackup-series", type=int, default=0,
+                    help="only export walg_basebackup for the N most recent "
+                         "basebackups (default: 0, no limit)")
 args = parser.parse_args()
+if args.max_basebackup_series < 0:
+    parser.error("--max-basebackup-series must be positive or 0")
 if args.debug:
     logging.basicConfig(level=logging.DEBUG)
 else:
@@ -35,8 +45,14 @@ for key in logging.Logger.manager.loggerDict:
 
 archive_dir = args.archive_dir
 http_port = 9351
-DONE_WAL_RE = re.compile(r"^[A-F0-9]{24}\.done$")
-READY_WAL_RE = re.compile(r"^[A-F0-9]{24}\.ready$")
+max_basebackup_series = args.max_basebackup_series
+pg_connect_args = dict(
+    host=os.getenv('PGHOST', 'localhost'),
+    port=os.getenv('PGPORT', '5432'),
+    user=os.getenv('PGUSER', 'postgres'),
+    password=os.getenv('PGPASSWORD'),
+    dbname=os.getenv('PGDATABASE', 'postgres'),
+)
 
 # TODO:
 # * walg_last_basebackup_duration
@@ -47,55 +63,86 @@ READY_WAL_RE = re.compile(r"^[A-F0-9]{24}\.ready$")
 
 def format_date(bb):
     # fix date format to include timezone
-    bb['date_fmt'] = bb['date_fmt'].replace('Z', '%z')
-    bb['time'] = parse_date(bb['time'], bb['date_fmt'])
-    bb['start_time'] = parse_date(bb['start_time'], bb['date_fmt'])
-    bb['finish_time'] = parse_date(bb['finish_time'], bb['date_fmt'])
+    fmt, fmt_no_fraction = date_formats(bb['date_fmt'])
+    bb['date_fmt'] = fmt
+    # 'time' (the storage modification time) is not used by any metric, leave
+    # it unparsed
+    bb['start_time'] = parse_date(bb['start_time'], fmt, fmt_no_fraction)
+    bb['finish_time'] = parse_date(bb['finish_time'], fmt, fmt_no_fraction)
     return bb
 
 
-def parse_date(date, fmt):
+@functools.lru_cache(maxsize=8)
+def date_formats(fmt):
+    # wal-g only ever sends a couple of distinct formats, build the strptime
+    # formats (with and without fractional seconds) once for each
     fmt = fmt.replace('Z', '%z')
+    return fmt, fmt.replace('.%f', '')
+
+
+def parse_date(date, fmt, fmt_no_fraction):
+    # wal-g dates are ISO 8601, fromisoformat is much faster than strptime
     try:
-        return datetime.datetime.strptime(date, fmt)
+        return datetime.datetime.fromisoformat(date.replace('Z', '+00:00'))
     except ValueError:
-        fmt = fmt.replace('.%f', '')
-        return datetime.datetime.strptime(date, fmt)
+        pass
+    # Go drops the fractional part when it is zero, pick the matching format
+    # up front instead of failing a first strptime
+    if '.' not in date:
+        fmt = fmt_no_fraction
+    return datetime.datetime.strptime(date, fmt)
 
 
-def get_previous_wal(wal):
+# Row of pg_stat_archiver, in the column order of the archive_status query
+ArchiveStatus = collections.namedtuple(
+    'ArchiveStatus', ['archived_count', 'failed_count',
+                      'last_archived_wal', 'last_archived_time',
+                      'last_failed_wal', 'last_failed_time'])
+
+
+# A WAL file name is TTTTTTTTXXXXXXXXYYYYYYYY (timeline, log id, segment).
+# With 16MB segments the segment part only goes from 00 to FF before the log
+# id is incremented, so it is not a plain 64-bit counter.
+XLOG_SEGMENTS_PER_XLOGID = 0x100
+
+
+@functools.lru_cache(maxsize=256)
+def _wal_to_int(wal):
+    # Split a WAL file name into its timeline and a linear segment number
     timeline = wal[0:8]
-    segment_low = int(wal[16:24], 16) - 1
-    segment_high = int(wal[8:16], 16) + (segment_low // 0x100)
-    segment_low = segment_low % 0x100
-    return '%s%08X%08X' % (timeline, segment_high, segment_low)
+    return timeline, (int(wal[8:16], 16) * XLOG_SEGMENTS_PER_XLOGID +
+                      int(wal[16:24], 16))
+
+
+def _int_to_wal(timeline, segment):
+    return '%s%08X%08X' % (timeline,
+                           segment // XLOG_SEGMENTS_PER_XLOGID,
+                           segment % XLOG_SEGMENTS_PER_XLOGID)
+
+
+def get_previous_wal(wal):
+    timeline, segment = _wal_to_int(wal)
+    return _int_to_wal(timeline, segment - 1)
 
 
 def get_next_wal(wal):
-    timeline = wal[0:8]
-    segment_low = int(wal[16:24], 16) + 1
-    segment_high = int(wal[8:16], 16) + (segment_low // 0x100)
-    segment_low = segment_low % 0x100
-    return '%s%08X%08X' % (timeline, segment_high, segment_low)
+    timeline, segment = _wal_to_int(wal)
+    return _int_to_wal(timeline, segment + 1)
 
 
 def is_before(a, b):
-    timeline_a = a[0:8]
-    timeline_b = b[0:8]
+    timeline_a, a_int = _wal_to_int(a)
+    timeline_b, b_int = _wal_to_int(b)
     if timeline_a != timeline_b:
         return False
-    a_int = int(a[8:16], 16) * 0x100 + int(a[16:24], 16)
-    b_int = int(b[8:16], 16) * 0x100 + int(b[16:24], 16)
     return a_int < b_int
 
 
 def wal_diff(a, b):
-    timeline_a = a[0:8]
-    timeline_b = b[0:8]
+    timeline_a, a_int = _wal_to_int(a)
+    timeline_b, b_int = _wal_to_int(b)
     if timeline_a != timeline_b:
         return -1
-    a_int = int(a[8:16], 16) * 0x100 + int(a[16:24], 16)
-    b_int = int(b[8:16], 16) * 0x100 + int(b[16:24], 16)
     return a_int - b_int
 
 
@@ -107,6 +154,10 @@ class Exporter():
         self.bbs = []
         self.last_archive_check = None
         self.archive_status = None
+        self.pg_conn = None
+        self.archive_status_lock = threading.Lock()
+        self.archive_dir_mtime = None
+        self.xlog_ready_count = 0
 
         # Declare metrics
         self.basebackup = Gauge('walg_basebackup',
@@ -114,34 +165,28 @@ class Exporter():
                                 ['start_wal_segment', 'start_lsn'])
         self.basebackup_count = Gauge('walg_basebackup_count',
                                       'Remote Basebackups count')
-        self.basebackup_count.set_function(lambda: len(self.bbs))
 
         self.last_upload = Gauge('walg_last_upload',
                                  'Last upload of incremental or full backup',
                                  ['type'])
-        self.last_upload.labels('xlog').set_function(
-            self.last_xlog_upload_callback)
-        self.last_upload.labels('basebackup').set_function(
-            lambda: self.bbs[len(self.bbs) - 1]['start_time'].timestamp()
-            if self.bbs else 0
-        )
+        # Keep labelled children around instead of looking them up again
+        self.last_upload_xlog = self.last_upload.labels('xlog')
+        self.last_upload_xlog.set_function(self.last_xlog_upload_callback)
+        self.last_upload_basebackup = self.last_upload.labels('basebackup')
         self.oldest_basebackup = Gauge('walg_oldest_basebackup',
                                        'oldest full backup')
-        self.oldest_basebackup.set_function(
-            lambda: self.bbs[0]['start_time'].timestamp() if self.bbs else 0
-        )
 
         self.xlog_ready = Gauge('walg_missing_remote_wal_segment_at_end',
                                 'Xlog ready for upload')
         self.xlog_ready.set_function(self.xlog_ready_callback)
 
         self.exception = Gauge('walg_exception',
-                               'Wal-g exception: 2 for basebackup error, '
-                               '3 for xlog error and '
-                               '5 for remote error')
+                               'Wal-g exception: 1 for basebackup error, '
+                               '2 for xlog error and '
+                               '3 for both')
         self.exception.set_function(
-            lambda: (1 if self.basebackup_exception else 0 +
-                     2 if self.xlog_exception else 0))
+            lambda: ((1 if self.basebackup_exception else 0) |
+                     (2 if self.xlog_exception else 0)))
 
         self.xlog_since_last_bb = Gauge('walg_xlogs_since_basebackup',
                                         'Xlog uploaded since last base backup')
@@ -149,11 +194,6 @@ class Exporter():
 
         self.last_backup_duration = Gauge('walg_last_backup_duration',
                                           'Duration of the last full backup')
-        self.last_backup_duration.set_function(
-            lambda: ((self.bbs[len(self.bbs) - 1]['finish_time'] -
-                      self.bbs[len(self.bbs) - 1]['start_time']).total_seconds()
-                     if self.bbs else 0)
-        )
         self.walg_backup_fuse = Gauge('walg_backup_fuse',"0 backup fuse is OK, 1 backup fuse is burnt")
         self.walg_backup_fuse.set_function(self.backup_fuse_callback)
         # Fetch remote base backups
@@ -171,90 +211,150 @@ class Exporter():
             res = subprocess.run(["wal-g", "backup-list",
                                   "--detail", "--json"],
                                  capture_output=True, check=True)
-            new_bbs = list(map(format_date, json.loads(res.stdout)))
-            new_bbs.sort(key=lambda bb: bb['start_time'])
-            new_bbs_name = [bb['backup_name'] for bb in new_bbs]
-            old_bbs_name = [bb['backup_name'] for bb in self.bbs]
-            bb_deleted = 0
-
-            # Remove metrics for deleted backups
-            for bb in self.bbs:
-                if bb['backup_name'] not in new_bbs_name:
-                    # Backup deleted
-                    self.basebackup.remove(bb['wal_file_name'],
-                                           bb['start_lsn'])
-                    bb_deleted = bb_deleted + 1
-            # Add metrics for new backups
-            for bb in new_bbs:
-                if bb['backup_name'] not in old_bbs_name:
-                    (self.basebackup.labels(bb['wal_file_name'],
-                                            bb['start_lsn'])
-                     .set(bb['start_time'].timestamp()))
+            new_bbs = list(map(format_date, json_loads(res.stdout)))
+            new_bbs.sort(key=operator.itemgetter('start_time'))
+            new_bbs_name = {bb['backup_name'] for bb in new_bbs}
+            old_bbs_name = {bb['backup_name'] for bb in self.bbs}
+            bb_deleted = len(old_bbs_name - new_bbs_name)
+
+            if new_bbs_name != old_bbs_name:
+                # Only the most recent backups get a walg_basebackup series
+                # (a limit of 0 slices the whole list)
+                old_series = self.bbs[-max_basebackup_series:]
+                new_series = new_bbs[-max_basebackup_series:]
+                old_series_name = {bb['backup_name'] for bb in old_series}
+                new_series_name = {bb['backup_name'] for bb in new_series}
+                # Remove metrics for deleted or too old backups
+                for bb in old_series:
+                    if bb['backup_name'] not in new_series_name:
+                        self.basebackup.remove(bb['wal_file_name'],
+                                               bb['start_lsn'])
+                # Add metrics for new backups
+                for bb in new_series:
+                    if bb['backup_name'] not in old_series_name:
+                        (self.basebackup.labels(bb['wal_file_name'],
+                                                bb['start_lsn'])
+                         .set(bb['start_time'].timestamp()))
             # Update backup list
             self.bbs = new_bbs
-            info("%s basebackups found (first: %s, last: %s), %s deleted",
-                 len(self.bbs),
-                 self.bbs[0]['start_time'],
-                 self.bbs[len(self.bbs) - 1]['start_time'],
-                 bb_deleted)
+
+            # Basebackup metrics only change here, compute them once
+            # instead of on every scrape
+            if new_bbs:
+                first, last = new_bbs[0], new_bbs[-1]
+                oldest_start = first['start_time'].timestamp()
+                last_start = last['start_time'].timestamp()
+                last_duration = (last['finish_time'] -
+                                 last['start_time']).total_seconds()
+                info("%s basebackups found (first: %s, last: %s), "
+                     "%s deleted",
+                     len(new_bbs),
+                     first['start_time'],
+                     last['start_time'],
+                     bb_deleted)
+            else:
+                oldest_start = last_start = last_duration = 0
+                info("No basebackup found, %s deleted", bb_deleted)
+            self.basebackup_count.set(len(new_bbs))
+            self.oldest_basebackup.set(oldest_start)
+            self.last_upload_basebackup.set(last_start)
+            self.last_backup_duration.set(last_duration)
 
             self.basebackup_exception = False
         except subprocess.CalledProcessError as e:
-            error(e)
+            error("wal-g backup-list failed: %s", e)
             self.basebackup_exception = True
 
     def last_archive_status(self):
-        if (self.last_archive_check is None or
-                datetime.datetime.now().timestamp() -
-                self.last_archive_check > 1):
-            self.archive_status = self._last_archive_status()
-            self.last_archive_check = datetime.datetime.now().timestamp()
-        return self.archive_status
+        # Scrapes are served by concurrent threads, only one of them may
+        # query (or reconnect) at a time
+        with self.archive_status_lock:
+            now = time.monotonic()
+            if (self.last_archive_check is None or
+                    now - self.last_archive_check > 1):
+                self.archive_status = self._last_archive_status()
+                self.last_archive_check = now
+            return self.archive_status
+
+    def _pg_connection(self):
+        # Keep a single connection open across scrapes
+        if self.pg_conn is None or self.pg_conn.closed:
+            # Only cache the connection once the statement is prepared
+            conn = psycopg2.connect(keepalives=1, **pg_connect_args)
+            try:
+                conn.autocommit = True
+                with conn.cursor() as c:
+                    c.execute('PREPARE archive_status AS '
+                              'SELECT archived_count, failed_count, '
+                              'last_archived_wal, '
+                              'last_archived_time, '
+                              'last_failed_wal, '
+                              'last_failed_time '
+                              'FROM pg_stat_archiver')
+            except Exception:
+                conn.close()
+                raise
+            self.pg_conn = conn
+        return self.pg_conn
 
     def _last_archive_status(self):
-        with psycopg2.connect(
-            host=os.getenv('PGHOST', 'localhost'),
-            port=os.getenv('PGPORT', '5432'),
-            user=os.getenv('PGUSER', 'postgres'),
-            password=os.getenv('PGPASSWORD'),
-            dbname=os.getenv('PGDATABASE', 'postgres'),
-
-        ) as db_connection:
-            db_connection.autocommit = True
-            with db_connection.cursor(cursor_factory=DictCursor) as c:
-                c.execute('SELECT archived_count, failed_count, '
-                          'last_archived_wal, '
-                          'last_archived_time, '
-                          'last_failed_wal, '
-                          'last_failed_time '
-                          'FROM pg_stat_archiver')
-                res = c.fetchone()
-                if not bool(result):
-                    raise Exception("Cannot fetch archive status")
-                return res
+        for attempt in range(2):
+            try:
+                db_connection = self._pg_connection()
+                with db_connection.cursor() as c:
+                    c.execute('EXECUTE archive_status')
+                    res = c.fetchone()
+                    if not bool(res):
+                        raise Exception("Cannot fetch archive status")
+                    return ArchiveStatus._make(res)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # Connection lost (server restart, idle timeout...), drop it
+                # and retry once on a fresh one
+                if self.pg_conn is not None:
+                    self.pg_conn.close()
+                    self.pg_conn = None
+                if attempt:
+                    raise
 
     def last_xlog_upload_callback(self):
         archive_status = self.last_archive_status()
-        return archive_status['last_archived_time'].timestamp()
+        return archive_status.last_archived_time.timestamp()
 
     def xlog_ready_callback(self):
-        res = 0
         try:
-            for f in os.listdir(archive_dir):
-                # search for xlog waiting for upload
-                if READY_WAL_RE.match(f):
-                    res += 1
+            # Creating, renaming or removing a status file updates the
+            # directory mtime, so only rescan when it changed.
+            mtime = os.stat(archive_dir).st_mtime_ns
+            if mtime != self.archive_dir_mtime:
+                with os.scandir(archive_dir) as it:
+                    # search for xlog waiting for upload, skipping
+                    # .history and .backup status files
+                    self.xlog_ready_count = sum(
+                        1 for entry in it
+                        if len(entry.name) == 30 and
+                        entry.name.endswith('.ready'))
+                # A fresh mtime may still be shared by a later change in the
+                # same timestamp tick, only remember it once it is old enough
+                # so the next scrape rescans in the meantime.
+                if time.time_ns() - mtime < 1000000000:
+                    self.archive_dir_mtime = None
+                else:
+                    self.archive_dir_mtime = mtime
             self.xlog_exception = 0
         except FileNotFoundError:
+            self.xlog_ready_count = 0
+            self.archive_dir_mtime = None
             self.xlog_exception = 1
-        return res
+        return self.xlog_ready_count
 
     def xlog_since_last_bb_callback(self):
         # Compute xlog_since_last_basebackup
-        if self.bbs:
+        bbs = self.bbs
+        if bbs:
             archive_status = self.last_archive_status()
-            return wal_diff(archive_status['last_archived_wal'],
-                            self.bbs[len(self.bbs) - 1]['wal_file_name'])
+            # Both names are parsed through the cached _wal_to_int
+            return wal_diff(archive_status.last_archived_wal,
+                            bbs[-1]['wal_file_name'])
         else:
             return 0
 
@@ -272,14 +372,7 @@ if __name__ == '__main__':
     # Check if this is a master instance
     while True:
         try:
-            with psycopg2.connect(
-                host=os.getenv('PGHOST', 'localhost'),
-                port=os.getenv('PGPORT', '5432'),
-                user=os.getenv('PGUSER', 'postgres'),
-                password=os.getenv('PGPASSWORD'),
-                dbname=os.getenv('PGDATABASE', 'postgres'),
-
-            ) as db_connection:
+            with psycopg2.connect(**pg_connect_args) as db_connection:
                 db_connection.autocommit = True
                 with db_connection.cursor() as c:
                     c.execute("SELECT NOT pg_is_in_recovery()")
@@ -289,15 +382,31 @@ if __name__ == '__main__':
                     else:
                         info("Running on slave, waiting for promotion...")
                         time.sleep(60)
-        except Exception:
-            error("Unable to connect postgres server, retrying in 60sec...")
+        except Exception as e:
+            error("Unable to connect postgres server: %s, "
+                  "retrying in 60sec...", e)
             time.sleep(60)
 
     # Launch exporter
     exporter = Exporter()
 
-    # listen to SIGHUP signal
-    signal.signal(signal.SIGHUP, exporter.update_basebackup)
+    # listen to SIGHUP signal, wal-g runs in a worker thread so the
+    # signal handler returns immediately. SIGHUPs received while a refresh
+    # is running are coalesced into a single follow-up refresh.
+    refresh_requested = threading.Event()
+
+    def refresh_basebackup():
+        while True:
+            refresh_requested.wait()
+            refresh_requested.clear()
+            try:
+                exporter.update_basebackup()
+            except Exception:
+                logging.exception("Unable to update basebackups")
+                exporter.basebackup_exception = True
+
+    threading.Thread(target=refresh_basebackup, daemon=True).start()
+    signal.signal(signal.SIGHUP, lambda *unused: refresh_requested.set())
 
     while True:
         time.sleep(1)